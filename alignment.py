@@ -0,0 +1,33 @@
+import os
+import json
+import threading
+
+def words_from_alignment(alignment):
+    """
+    Collapse ElevenLabs character timings into [[word, start, end], ...] (seconds, clip-relative).
+    """
+    words, current, start, end = [], "", 0.0, 0.0
+    for ch, ch_start, ch_end in zip(alignment.characters, alignment.character_start_times_seconds,
+                                    alignment.character_end_times_seconds):
+        if ch.isspace():
+            if current:
+                words.append([current, round(start, 3), round(end, 3)])
+            current = ""
+            continue
+        if not current:
+            start = ch_start
+        current += ch
+        end = ch_end
+    if current:
+        words.append([current, round(start, 3), round(end, 3)])
+    return words
+
+def write_words_sidecar(path, words):
+    """
+    Atomically write a compact {"words": [...]} sidecar (per-thread temp name, then rename).
+    """
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        json.dump({"words": words}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    return path
@@ -1,15 +1,26 @@
 import streamlit as st
 import os
 import pandas as pd
+import numpy as np
 import subprocess
 import io
+import json
+import base64
+import hashlib
+import time
+import threading
+import math
 import zipfile
+import csv
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 import google.generativeai as genai
 from elevenlabs.client import ElevenLabs
 from elevenlabs import save, VoiceSettings
 
+from alignment import words_from_alignment, write_words_sidecar
+
 # Load env variables
 load_dotenv()
 
@@ -204,7 +215,33 @@ OUTPUT_DIR_RAW = "output_toefl_raw"
 OUTPUT_DIR_FINAL = "output_toefl_final"
 FINAL_FILENAME = "toefl_master_track.mp3"
 
-for d in [OUTPUT_DIR_RAW, OUTPUT_DIR_FINAL]:
+# Clips are requested as constant-bitrate MP3 so their length can be read off the file size
+OUTPUT_FORMAT = "mp3_44100_128"
+OUTPUT_KBPS = 128
+SAMPLE_RATE = 44100
+MODEL_ID = "eleven_multilingual_v2"
+
+# Waveform peaks: min/max per PEAKS_BLOCK samples of PEAKS_SAMPLE_RATE mono PCM (125 peaks/s at full detail),
+# halved per level until a level fits PEAKS_MIN_LEN. Stored as int8 sidecars.
+PEAKS_DIR = os.path.join(OUTPUT_DIR_FINAL, "peaks")
+PEAKS_MAGIC = b"TPK1"
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_BLOCK = 64
+PEAKS_MIN_LEN = 512
+PEAKS_DISPLAY_WIDTH = 1200
+
+# Pipelined parse -> synthesis: concurrent ElevenLabs requests while Gemini is still streaming
+PIPELINE_WORKERS = int(os.getenv("TOEFL_TTS_WORKERS", "3"))
+# ElevenLabs answers 429 once the account's concurrency limit is hit; back off and retry instead of failing
+TTS_MAX_RETRIES = int(os.getenv("TOEFL_TTS_RETRIES", "4"))
+TTS_BACKOFF_SECONDS = 1.0
+
+# Preview renders: small enough for st.audio to load instantly
+PREVIEW_FILENAME = "toefl_master_preview.mp3"
+PREVIEW_BITRATE = "32k"
+PREVIEW_SAMPLE_RATE = 22050
+
+for d in [OUTPUT_DIR_RAW, OUTPUT_DIR_FINAL, PEAKS_DIR]:
     os.makedirs(d, exist_ok=True)
 
 # --- TOEFL Task Presets (The Core Logic) ---
@@ -273,6 +310,48 @@ VOICE_REGISTRY = {
     "Student (F)": {"id": "FGY2WhTYpPnrIDTdsKH5", "stability": 0.45, "similarity": 0.75}, # Laura
 }
 
+# --- Pre-warm Library ---
+# Standard Narrator instructions/transitions, synthesized in the background when the app starts
+# so a render finds them already in OUTPUT_DIR_RAW. Keyed by task name; lines must match the script verbatim to hit.
+PREWARM_ENABLED = os.getenv("TOEFL_PREWARM", "1") != "0"
+PREWARM_LIBRARY = {
+    "Academic Lecture": [
+        "Listen to part of a lecture in a class.",
+        "Now get ready to answer the questions. You may use your notes to help you answer.",
+    ],
+    "Campus Conversation": [
+        "Listen to a conversation between a student and a university employee.",
+        "Now get ready to answer the questions. You may use your notes to help you answer.",
+    ],
+    "Peer-to-Peer (New 2026)": [
+        "Listen to a conversation between two students.",
+        "Now get ready to answer the questions. You may use your notes to help you answer.",
+    ],
+    "Listen & Repeat (New 2026)": [
+        "Listen and repeat only once.",
+        "Now, listen and repeat.",
+    ],
+    "Virtual Interview (New 2026)": [
+        "You will now take part in a short interview. Answer each question as fully as you can.",
+    ],
+    "Integrated Task (Campus)": [
+        "Now listen to two students discussing the announcement.",
+    ],
+    "Integrated Task (Academic)": [
+        "Now listen to part of a lecture on this topic.",
+    ],
+}
+# TOEFL_PREWARM_LIBRARY may point to a JSON file ({"<task name>": ["line", ...]}) that replaces the library above
+PREWARM_LIBRARY_FILE = os.getenv("TOEFL_PREWARM_LIBRARY", "")
+PREWARM_LIBRARY_ERROR = None
+if PREWARM_LIBRARY_FILE:
+    try:
+        with open(PREWARM_LIBRARY_FILE, encoding='utf-8') as f:
+            PREWARM_LIBRARY = {str(task): [str(line) for line in lines] for task, lines in json.load(f).items()}
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        PREWARM_LIBRARY_ERROR = f"Could not load {PREWARM_LIBRARY_FILE}, using the built-in library: {e}"
+PREWARM_TEXTS = {line for lines in PREWARM_LIBRARY.values() for line in lines}
+
 # --- Helpers ---
 def get_voice_for_role(role_name, task_config):
     """
@@ -299,11 +378,8 @@ def get_voice_for_role(role_name, task_config):
 
     return VOICE_REGISTRY["Narrator"] # Final Fallback
 
-def parse_with_gemini(text, task_name, task_info, api_key):
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.5-flash')
-    
-    prompt = f"""
+def build_parse_prompt(task_name, task_info):
+    return f"""
     You are a TOEFL Script Formatter.
     Task: {task_name} (Roles: {", ".join(task_info['roles'])})
     
@@ -322,6 +398,11 @@ def parse_with_gemini(text, task_name, task_info, api_key):
     "Narrator","Listen to a conversation between a student and a professor."
     "Student","Hi professor."
     """
+
+def parse_with_gemini(text, task_name, task_info, api_key):
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    prompt = build_parse_prompt(task_name, task_info)
     try:
         response = model.generate_content([prompt, text])
         cleaned_csv = response.text.replace("```csv", "").replace("```", "").strip()
@@ -334,22 +415,344 @@ def parse_with_gemini(text, task_name, task_info, api_key):
                 st.code(response.text)
         return None
 
-def get_audio_duration(file_path):
-    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-    try:
-        res = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return float(res.stdout.strip())
-    except: return 0.0
-
 def generate_silence(duration, name):
     path = os.path.join(OUTPUT_DIR_FINAL, name)
     subprocess.run(["ffmpeg", "-y", "-f", "lavfi", "-i", f"aevalsrc=0:d={duration}", "-q:a", "2", path], 
                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     return path
 
-def produce_audio(df, task_config, api_key):
+def estimate_clip_duration(file_path, kbps=OUTPUT_KBPS):
+    """
+    Duration of a CBR MP3 from its size, so the mixer never has to ffprobe a clip.
+    """
+    try:
+        return os.path.getsize(file_path) * 8 / (kbps * 1000)
+    except OSError: return 0.0
+
+def encoded_silence_duration(duration):
+    """
+    Length of a silence file once LAME has framed it (1152 samples/frame, ~1105 samples of delay + padding).
+    Concat with -c copy keeps every frame, so this is what the gap actually adds to the master.
+    """
+    frames = math.ceil((duration * SAMPLE_RATE + 1105) / 1152)
+    return frames * 1152 / SAMPLE_RATE
+
+def _format_timestamp(seconds, ms_sep):
+    ms = int(round(seconds * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d}{ms_sep}{ms:03d}"
+
+def _cue_text(text):
+    # A blank line ends a cue, so keep only the non-empty lines of multi-line text
+    return "\n".join(line.strip() for line in str(text).splitlines() if line.strip())
+
+def _vtt_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def export_timeline(timeline, master_path):
+    """
+    Write the mix timeline next to the master as JSON (every line and pause), WebVTT and SRT (spoken lines only).
+    """
+    base = os.path.splitext(master_path)[0]
+    paths = {"json": f"{base}.json", "vtt": f"{base}.vtt", "srt": f"{base}.srt"}
+    lines = [seg for seg in timeline if seg['kind'] == "line"]
+
+    with open(paths['json'], 'w', encoding='utf-8') as f:
+        json.dump({"master": os.path.basename(master_path), "segments": timeline}, f, ensure_ascii=False, indent=2)
+
+    with open(paths['vtt'], 'w', encoding='utf-8') as f:
+        f.write("WEBVTT\n\n")
+        for n, seg in enumerate(lines, 1):
+            f.write(f"{n}\n{_format_timestamp(seg['start'], '.')} --> {_format_timestamp(seg['end'], '.')}\n")
+            role = _vtt_escape(" ".join(str(seg['role']).split()))
+            f.write(f"<v {role}>{_vtt_escape(_cue_text(seg['text']))}\n\n")
+
+    with open(paths['srt'], 'w', encoding='utf-8') as f:
+        for n, seg in enumerate(lines, 1):
+            f.write(f"{n}\n{_format_timestamp(seg['start'], ',')} --> {_format_timestamp(seg['end'], ',')}\n")
+            f.write(f"{' '.join(str(seg['role']).split())}: {_cue_text(seg['text'])}\n\n")
+
+    return paths
+
+# --- Waveform Peaks ---
+def decode_pcm(file_path):
+    """
+    Decode to mono 16-bit PCM at PEAKS_SAMPLE_RATE via ffmpeg; empty array on failure.
+    """
+    cmd = ["ffmpeg", "-v", "error", "-i", file_path, "-ac", "1", "-ar", str(PEAKS_SAMPLE_RATE), "-f", "s16le", "-"]
+    try:
+        res = subprocess.run(cmd, capture_output=True, check=True)
+        return np.frombuffer(res.stdout, dtype="<i2")
+    except Exception: return np.zeros(0, dtype="<i2")
+
+def compute_peaks(samples):
+    """
+    Finest level: (n, 2) int8 array of per-block [min, max].
+    """
+    n_blocks = -(-len(samples) // PEAKS_BLOCK)
+    padded = np.zeros(n_blocks * PEAKS_BLOCK, dtype="<i2")
+    padded[:len(samples)] = samples
+    blocks = padded.reshape(n_blocks, PEAKS_BLOCK)
+    peaks = np.stack([blocks.min(axis=1), blocks.max(axis=1)], axis=1)
+    return (peaks >> 8).astype(np.int8)
+
+def build_peak_levels(base):
+    levels = [base]
+    while len(levels[-1]) > PEAKS_MIN_LEN:
+        cur = levels[-1]
+        if len(cur) % 2:
+            cur = np.concatenate([cur, cur[-1:]])
+        pairs = cur.reshape(-1, 2, 2)
+        levels.append(np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1))
+    return levels
+
+def write_peaks(path, levels):
+    header = np.array([PEAKS_SAMPLE_RATE, PEAKS_BLOCK, len(levels)] + [len(l) for l in levels], dtype="<u4")
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    with open(tmp_path, 'wb') as f:
+        f.write(PEAKS_MAGIC)
+        f.write(header.tobytes())
+        for level in levels:
+            f.write(np.ascontiguousarray(level, dtype=np.int8).tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+def read_peaks(path):
+    """
+    Memory-map a peaks sidecar; returns {"rate", "block", "levels"} without reading the level data.
+    """
+    with open(path, 'rb') as f:
+        if f.read(4) != PEAKS_MAGIC:
+            raise ValueError(f"Not a peaks file: {path}")
+        rate, block, n_levels = np.frombuffer(f.read(12), dtype="<u4")
+        lengths = np.frombuffer(f.read(4 * int(n_levels)), dtype="<u4")
+    data = np.memmap(path, dtype=np.int8, mode='r', offset=16 + 4 * int(n_levels))
+    levels, pos = [], 0
+    for length in lengths:
+        levels.append(data[pos:pos + 2 * int(length)].reshape(int(length), 2))
+        pos += 2 * int(length)
+    return {"rate": int(rate), "block": int(block), "levels": levels}
+
+def clip_peaks_path(clip_path):
+    return os.path.join(PEAKS_DIR, os.path.splitext(os.path.basename(clip_path))[0] + ".peaks")
+
+def get_clip_peaks(clip_path):
+    """
+    Finest peak level for a clip. Clips are content-addressed, so an existing sidecar is never stale
+    and only newly synthesized clips get decoded. Returns None (and writes nothing) if the clip can't be decoded.
+    """
+    path = clip_peaks_path(clip_path)
+    if os.path.exists(path):
+        try:
+            return read_peaks(path)['levels'][0]
+        except (ValueError, OSError): pass
+    samples = decode_pcm(clip_path)
+    if not len(samples):
+        return None
+    levels = build_peak_levels(compute_peaks(samples))
+    write_peaks(path, levels)
+    return levels[0]
+
+def build_master_peaks(timeline, clips, master_path):
+    """
+    Assemble master peaks from per-clip sidecars and zero runs for the pauses -- the master itself is never decoded.
+    """
+    parts = []
+    buckets_per_second = PEAKS_SAMPLE_RATE / PEAKS_BLOCK
+    for seg in timeline:
+        # Bucket counts come from the cumulative timeline, so per-clip rounding never accumulates into drift
+        # against the cue sheet; each clip's own peaks are padded/trimmed to fit its span
+        n = int(round(seg['end'] * buckets_per_second)) - int(round(seg['start'] * buckets_per_second))
+        span = np.zeros((n, 2), dtype=np.int8)
+        clip_peaks = get_clip_peaks(clips[seg['index']]['path']) if seg['kind'] == "line" else None
+        if clip_peaks is not None:
+            # Pauses, and any clip that failed to decode, stay a flat run
+            fit = min(n, len(clip_peaks))
+            span[:fit] = clip_peaks[:fit]
+        parts.append(span)
+    base = np.concatenate(parts) if parts else np.zeros((0, 2), dtype=np.int8)
+    return write_peaks(os.path.splitext(master_path)[0] + ".peaks", build_peak_levels(base))
+
+def peaks_for_display(peaks_file, width=PEAKS_DISPLAY_WIDTH):
+    """
+    Coarsest level with at least `width` buckets (or the finest, for short clips), as a time-indexed DataFrame.
+    """
+    peaks = read_peaks(peaks_file)
+    levels = peaks['levels']
+    k = 0
+    while k + 1 < len(levels) and len(levels[k + 1]) >= width:
+        k += 1
+    level = np.asarray(levels[k], dtype=np.float32) / 128.0
+    step = peaks['block'] * (2 ** k) / peaks['rate']
+    return pd.DataFrame({"min": level[:, 0], "max": level[:, 1]},
+                        index=pd.Index(np.arange(len(level)) * step, name="seconds"))
+
+def resolve_voice_settings(role, task_config):
+    """
+    Voice id + settings for a role, including the P2P stability override.
+    """
+    v_config = get_voice_for_role(role, task_config)
+    stability = v_config['stability']
+    if task_config['mix_logic'] == "p2p" and "Student" in str(role):
+        stability = 0.45 # Force lower stability for P2P students
+    return v_config['id'], stability, v_config['similarity']
+
+def clip_cache_path(text, voice_id, stability, similarity):
+    """
+    Content-addressed clip path: the same line in the same voice/settings is only ever synthesized once.
+    """
+    key = f"{MODEL_ID}|{OUTPUT_FORMAT}|{voice_id}|{stability}|{similarity}|{text}"
+    return os.path.join(OUTPUT_DIR_RAW, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16] + ".mp3")
+
+def clip_words_path(clip_path):
+    return os.path.splitext(clip_path)[0] + ".words.json"
+
+def load_clip_words(clip_path):
+    try:
+        with open(clip_words_path(clip_path), encoding='utf-8') as f:
+            return json.load(f)['words']
+    except (OSError, ValueError, KeyError): return []
+
+def call_with_backoff(fetch):
+    """
+    Run `fetch()`, retrying with exponential backoff while ElevenLabs answers 429 (too many concurrent requests).
+    """
+    for attempt in range(TTS_MAX_RETRIES + 1):
+        try:
+            return fetch()
+        except Exception as e:
+            if getattr(e, "status_code", None) != 429 or attempt == TTS_MAX_RETRIES:
+                raise
+            time.sleep(TTS_BACKOFF_SECONDS * 2 ** attempt)
+
+# Serializes the final rename of a clip and its words sidecar, so concurrent fetches of the same clip
+# (pre-warm, pipelined workers) can never leave audio and timings from different requests side by side
+_CLIP_COMMIT_LOCK = threading.Lock()
+
+def synthesize_clip(client, role, text, task_config, with_words=False):
+    """
+    Returns (path, cache_hit). Only calls ElevenLabs when the clip is not already in OUTPUT_DIR_RAW
+    (or, with_words, when it has no word-timing sidecar yet).
+    """
+    voice_id, stability, similarity = resolve_voice_settings(role, task_config)
+    out_path = clip_cache_path(text, voice_id, stability, similarity)
+    words_path = clip_words_path(out_path)
+    if os.path.exists(out_path) and (not with_words or os.path.exists(words_path)):
+        return out_path, True
+
+    request = dict(
+        text=text,
+        voice_id=voice_id,
+        model_id=MODEL_ID,
+        output_format=OUTPUT_FORMAT,
+        voice_settings=VoiceSettings(
+            stability=stability,
+            similarity_boost=similarity,
+            use_speaker_boost=True
+        )
+    )
+    # Write to a temp name first so an interrupted download never poisons the cache
+    # (per-thread, since the pre-warm worker may be fetching the same clip)
+    tmp_path = f"{out_path}.{threading.get_ident()}.part"
+
+    def fetch():
+        # convert() streams lazily, so the request (and any 429) happens inside save()
+        if with_words:
+            # Same request, timings included -- no separate alignment pass
+            response = client.text_to_speech.convert_with_timestamps(**request)
+            with open(tmp_path, 'wb') as f:
+                f.write(base64.b64decode(response.audio_base_64))
+            return words_from_alignment(response.alignment) if response.alignment else []
+        save(client.text_to_speech.convert(**request), tmp_path)
+        return None
+
+    try:
+        words = call_with_backoff(fetch)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    with _CLIP_COMMIT_LOCK:
+        if words is None:
+            if os.path.exists(out_path):
+                # Another fetch landed first; keep its audio (and any timings that match it)
+                os.remove(tmp_path)
+                return out_path, False
+            # No clip existed, so any sidecar left here belongs to audio that is gone
+            if os.path.exists(words_path):
+                os.remove(words_path)
+        else:
+            write_words_sidecar(words_path, words)
+        os.replace(tmp_path, out_path)
+
+        # New audio, so peaks from any previous audio no longer apply
+        if os.path.exists(clip_peaks_path(out_path)):
+            os.remove(clip_peaks_path(out_path))
+    return out_path, False
+
+@st.cache_resource
+def get_prewarm_state():
+    """
+    Process-wide pre-warm worker status and hit metrics (shared across sessions and reruns).
+    """
+    return {
+        "lock": threading.Lock(), "started": False, "done": False,
+        "ready": 0, "failed": 0, "total": 0,
+        "library_hits": 0, "library_misses": 0,
+        "first_clip": {"hit": [], "miss": []},
+    }
+
+def prewarm_worker(api_key, state):
+    client = ElevenLabs(api_key=api_key)
+    jobs = []
+    for section in TOEFL_CONFIGS.values():
+        for name, config in section.items():
+            for text in PREWARM_LIBRARY.get(name, []):
+                jobs.append((text, config))
+    with state['lock']:
+        state['total'] = len(jobs)
+
+    for text, config in jobs:
+        try:
+            # With timings, so pre-warmed clips also hit when "Capture word timings" is on
+            synthesize_clip(client, "Narrator", text, config, with_words=True)
+            key = "ready"
+        except Exception:
+            key = "failed"
+        with state['lock']:
+            state[key] += 1
+
+    with state['lock']:
+        state['done'] = True
+
+def start_prewarm(api_key):
+    """
+    Kick off the pre-warm worker once per process; later reruns are no-ops.
+    """
+    state = get_prewarm_state()
+    with state['lock']:
+        if state['started']:
+            return state
+        state['started'] = True
+    threading.Thread(target=prewarm_worker, args=(api_key, state), daemon=True, name="toefl-prewarm").start()
+    return state
+
+def record_prewarm_usage(text, hit, seconds, first=False):
+    state = get_prewarm_state()
+    # Only library lines count: a hit on any other cached clip (re-render, edited script) isn't pre-warm's doing
+    if text not in PREWARM_TEXTS:
+        return
+    with state['lock']:
+        state['library_hits' if hit else 'library_misses'] += 1
+        if first:
+            state['first_clip']['hit' if hit else 'miss'].append(seconds)
+
+def synthesize_clips(df, task_config, api_key, with_words=False):
     client = ElevenLabs(api_key=api_key)
-    assets = []
+    clips = []
     
     # 1. Generate
     prog_bar = st.progress(0, text="Generating Voices...")
@@ -361,51 +764,49 @@ def produce_audio(df, task_config, api_key):
             df = df.rename(columns={df.columns[0]: 'role', df.columns[1]: 'text'})
         else:
             st.error("Data Error: Table must have at least two columns (Role, Text).")
-            return None, None
+            return None
 
-    for i, row in df.iterrows():
-        role = row['role']
-        text = row['text']
-        
-        # Resolve Voice Settings
-        v_config = get_voice_for_role(role, task_config)
-        
-        # Override stability for P2P mode if needed
-        stability = v_config['stability']
-        if task_config['mix_logic'] == "p2p" and "Student" in role:
-            stability = 0.45 # Force lower stability for P2P students
-            
-        filename = f"{i:03d}_{role[:5]}.mp3"
-        out_path = os.path.join(OUTPUT_DIR_RAW, filename)
+    for n, (_, row) in enumerate(df.iterrows()):
+        role = str(row['role'])
+        text = str(row['text'])
         
         try:
-            audio = client.text_to_speech.convert(
-                text=text,
-                voice_id=v_config['id'],
-                model_id="eleven_multilingual_v2",
-                voice_settings=VoiceSettings(
-                    stability=stability,
-                    similarity_boost=v_config['similarity'],
-                    use_speaker_boost=True
-                )
-            )
-            save(audio, out_path)
-            assets.append(out_path)
+            t0 = time.perf_counter()
+            out_path, hit = synthesize_clip(client, role, text, task_config, with_words)
+            record_prewarm_usage(text, hit, time.perf_counter() - t0, first=(n == 0))
         except Exception as e:
             st.error(f"Gen Error: {e}")
-            return None, None
-        prog_bar.progress((i+1)/len(df))
-        
-    # 2. Mix
+            return None
+        clips.append({"path": out_path, "role": role, "text": text, "name": f"{n:03d}_{role[:5]}.mp3"})
+        prog_bar.progress((n+1)/len(df))
+
+    return clips
+
+def mix_track(clips, task_config, preview=False):
+    """
+    Concatenate cached clips into the master. Preview renders a low-bitrate mono MP3 and skips the ZIP;
+    the full render is a stream copy, so promoting a preview never touches the TTS API.
+    """
     st.write("Mixing Audio Track...")
     concat_path = os.path.join(OUTPUT_DIR_FINAL, "concat.txt")
     mix_logic = task_config['mix_logic']
+    timeline = []
+    words = []
+    cursor = 0.0
     
     with open(concat_path, 'w') as f:
-        for i, path in enumerate(assets):
+        for i, clip in enumerate(clips):
             # Use ABSOLUTE PATHS to avoid FFmpeg directory confusion
-            abs_path = os.path.abspath(path)
+            abs_path = os.path.abspath(clip['path'])
             f.write(f"file '{abs_path}'\n")
+
+            dur = estimate_clip_duration(clip['path'])
+            timeline.append({"index": i, "kind": "line", "role": clip['role'], "text": clip['text'],
+                             "start": round(cursor, 3), "end": round(cursor + dur, 3)})
+            # Rebase this clip's word timings (if it has any) onto master time
+            words.extend([i, w, round(cursor + start, 3), round(cursor + end, 3)]
+                         for w, start, end in load_clip_words(clip['path']))
+            cursor += dur
             
             # Silence Logic
             pause = 0.5 # Default
@@ -413,36 +814,175 @@ def produce_audio(df, task_config, api_key):
             if mix_logic == "p2p":
                 pause = 0.1 # Fast
             elif mix_logic == "listen_repeat":
-                dur = get_audio_duration(path)
                 pause = max(2.0, dur * 1.5)
             elif mix_logic == "interview":
                 pause = 5.0 # Fixed gap
                 
             # Don't add silence after last clip
-            if i < len(assets) - 1:
-                sil = generate_silence(pause, f"sil_{i}.mp3")
-                sil_abs = os.path.abspath(sil)
-                f.write(f"file '{sil_abs}'\n")
+            if i < len(clips) - 1:
+                # Silences are keyed by length, so each distinct gap is encoded once and reused
+                sil_name = f"sil_{int(round(pause * 1000))}ms.mp3"
+                sil_path = os.path.join(OUTPUT_DIR_FINAL, sil_name)
+                if not os.path.exists(sil_path):
+                    generate_silence(pause, sil_name)
+                f.write(f"file '{os.path.abspath(sil_path)}'\n")
+
+                gap = encoded_silence_duration(pause)
+                timeline.append({"index": i, "kind": "pause", "role": None, "text": None,
+                                 "start": round(cursor, 3), "end": round(cursor + gap, 3)})
+                cursor += gap
                 
-    final_path = os.path.join(OUTPUT_DIR_FINAL, FINAL_FILENAME)
+    if preview:
+        final_path = os.path.join(OUTPUT_DIR_FINAL, PREVIEW_FILENAME)
+        encode_args = ["-ac", "1", "-ar", str(PREVIEW_SAMPLE_RATE), "-c:a", "libmp3lame", "-b:a", PREVIEW_BITRATE]
+    else:
+        final_path = os.path.join(OUTPUT_DIR_FINAL, FINAL_FILENAME)
+        encode_args = ["-c", "copy"]
     
     # Run FFmpeg (capture output to debug if needed)
     try:
         subprocess.run(
-            ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_path, "-c", "copy", final_path],
+            ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_path] + encode_args + [final_path],
             stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
         )
     except subprocess.CalledProcessError as e:
         st.error(f"FFmpeg Merge Failed: {e.stderr.decode()}")
-        return None, None
+        return None
 
-    # 3. Zip Creation
-    zip_path = os.path.join(OUTPUT_DIR_FINAL, "clips.zip")
-    with zipfile.ZipFile(zip_path, 'w') as zipf:
-        for asset in assets:
-            zipf.write(asset, os.path.basename(asset))
+    # Cue sheet / subtitles / peaks straight from the durations used above. Those are stream-copy
+    # durations; the preview re-encode trims each silence's encoder padding, so previews get none.
+    cue_paths, peaks_path = None, None
+    if not preview:
+        cue_paths = export_timeline(timeline, final_path)
+        if words:
+            cue_paths['words'] = os.path.splitext(final_path)[0] + ".words.json"
+            with open(cue_paths['words'], 'w', encoding='utf-8') as f:
+                json.dump({"master": os.path.basename(final_path), "fields": ["index", "word", "start", "end"], "words": words},
+                          f, ensure_ascii=False, separators=(",", ":"))
+        peaks_path = build_master_peaks(timeline, clips, final_path)
 
-    return final_path, zip_path
+    # 3. Zip Creation (full render only)
+    zip_path = None
+    if not preview:
+        zip_path = os.path.join(OUTPUT_DIR_FINAL, "clips.zip")
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for clip in clips:
+                zipf.write(clip['path'], clip['name'])
+
+    return {"master": final_path, "zip": zip_path, "cues": cue_paths, "peaks": peaks_path, "preview": preview}
+
+def iter_csv_rows(chunks):
+    """
+    Yield parsed CSV records from streamed text as soon as each one is complete.
+    A record is complete at a newline outside quotes, so quoted text may span lines. Code fences are dropped.
+    """
+    buffer = ""
+    pending = []
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if not pending and (not line.strip() or line.strip().startswith("```")):
+                continue
+            pending.append(line)
+            record = "\n".join(pending)
+            if record.count('"') % 2 == 0:
+                pending = []
+                yield next(csv.reader([record], skipinitialspace=True))
+    tail = "\n".join(pending + [buffer]).strip()
+    if tail and not tail.startswith("```"):
+        yield next(csv.reader([tail], skipinitialspace=True))
+
+def _timed_synthesize(client, role, text, task_config, with_words=False):
+    t0 = time.perf_counter()
+    path, hit = synthesize_clip(client, role, text, task_config, with_words)
+    return path, hit, time.perf_counter() - t0
+
+def stream_parse_and_synthesize(raw_text, task_name, task_config, gemini_key, eleven_key, with_words=False):
+    """
+    One-click mode: stream the Gemini CSV and hand each row to the TTS pool as soon as it is complete,
+    so parse and synthesis latency overlap. Returns (df, clips, timings) or (None, None, None).
+    """
+    genai.configure(api_key=gemini_key)
+    model = genai.GenerativeModel('gemini-2.5-flash')
+    client = ElevenLabs(api_key=eleven_key)
+    prompt = build_parse_prompt(task_name, task_config)
+
+    status = st.status("Parsing and generating voices...", expanded=True)
+    rows, futures = [], []
+    t_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as pool:
+        try:
+            response = model.generate_content([prompt, raw_text], stream=True)
+            for n, fields in enumerate(iter_csv_rows(chunk.text for chunk in response)):
+                # Like the batch path's read_csv, the first record is always the header (whatever the LLM
+                # named the columns); malformed rows are skipped
+                if n == 0:
+                    continue
+                if len(fields) < 2:
+                    continue
+                role, text = fields[0].strip(), fields[1].strip()
+                rows.append((role, text))
+                futures.append(pool.submit(_timed_synthesize, client, role, text, task_config, with_words))
+                status.write(f"Queued line {len(rows)}: {role}")
+        except Exception as e:
+            pool.shutdown(wait=False, cancel_futures=True)
+            status.update(label="Parsing failed", state="error")
+            st.error(f"LLM Parsing Error: {e}")
+            return None, None, None
+        t_parsed = time.perf_counter()
+
+        clips = []
+        for n, ((role, text), future) in enumerate(zip(rows, futures)):
+            try:
+                out_path, hit, seconds = future.result()
+            except Exception as e:
+                pool.shutdown(wait=False, cancel_futures=True)
+                status.update(label="Generation failed", state="error")
+                st.error(f"Gen Error: {e}")
+                return None, None, None
+            record_prewarm_usage(text, hit, seconds, first=(n == 0))
+            clips.append({"path": out_path, "role": role, "text": text, "name": f"{n:03d}_{role[:5]}.mp3"})
+    t_done = time.perf_counter()
+
+    if not rows:
+        status.update(label="No lines parsed", state="error")
+        return None, None, None
+
+    status.update(label=f"Parsed and voiced {len(rows)} lines", state="complete", expanded=False)
+    timings = {"parse": t_parsed - t_start, "synthesis": t_done - t_start}
+    return pd.DataFrame(rows, columns=['role', 'text']), clips, timings
+
+def produce_audio(df, task_config, api_key, preview=False, with_words=False):
+    timings = {}
+    t0 = time.perf_counter()
+    clips = synthesize_clips(df, task_config, api_key, with_words)
+    if clips is None:
+        return None
+    timings['synthesis'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    render = mix_track(clips, task_config, preview=preview)
+    if render is None:
+        return None
+    timings['mix'] = time.perf_counter() - t0
+
+    render.update({"clips": clips, "task_config": task_config, "timings": timings})
+    return render
+
+def promote_render(render):
+    """
+    Re-run only the output stage of a preview at full quality, reusing its clips.
+    """
+    t0 = time.perf_counter()
+    final = mix_track(render['clips'], render['task_config'], preview=False)
+    if final is None:
+        return None
+    final.update({"clips": render['clips'], "task_config": render['task_config'],
+                  "timings": {"synthesis": 0.0, "mix": time.perf_counter() - t0},
+                  "preview_timings": render['timings']})
+    return final
 
 # --- UI Interface ---
 
@@ -450,6 +990,29 @@ st.sidebar.header("🔑 API Keys")
 key_eleven = st.sidebar.text_input("ElevenLabs Key", value=os.getenv("ELEVENLABS_API_KEY", ""), type="password")
 key_gemini = st.sidebar.text_input("Gemini Key", value=os.getenv("GEMINI_API_KEY", ""), type="password")
 
+if PREWARM_ENABLED and key_eleven:
+    prewarm = start_prewarm(key_eleven)
+    with st.sidebar.expander("🔥 Pre-warmed Clips"):
+        if PREWARM_LIBRARY_ERROR:
+            st.warning(PREWARM_LIBRARY_ERROR)
+        with prewarm['lock']:
+            ready, total, failed = prewarm['ready'], prewarm['total'], prewarm['failed']
+            lib_hits, lib_misses = prewarm['library_hits'], prewarm['library_misses']
+            first_hits = list(prewarm['first_clip']['hit'])
+            first_misses = list(prewarm['first_clip']['miss'])
+        st.caption(f"Library: {ready}/{total} ready" + (f" · {failed} failed" if failed else ""))
+        if lib_hits + lib_misses:
+            st.metric("Library hit rate", f"{lib_hits / (lib_hits + lib_misses):.0%}")
+        if first_hits or first_misses:
+            renders = len(first_hits) + len(first_misses)
+            st.metric("First-clip hit rate", f"{len(first_hits) / renders:.0%}",
+                      help=f"Over {renders} renders that open with a library line")
+            if first_hits and first_misses:
+                avg_hit = sum(first_hits) / len(first_hits)
+                avg_miss = sum(first_misses) / len(first_misses)
+                st.metric("First-clip latency (hit vs miss)", f"{avg_hit * 1000:.0f} ms",
+                          delta=f"-{(avg_miss - avg_hit):.2f}s vs {avg_miss:.2f}s cold", delta_color="inverse")
+
 st.sidebar.divider()
 
 st.sidebar.header("📚 Question Type")
@@ -457,6 +1020,10 @@ section = st.sidebar.selectbox("Test Section", list(TOEFL_CONFIGS.keys()))
 task_name = st.sidebar.radio("Task", list(TOEFL_CONFIGS[section].keys()))
 task_config = TOEFL_CONFIGS[section][task_name]
 
+st.sidebar.divider()
+capture_words = st.sidebar.checkbox("🔤 Capture word timings", value=False,
+                                    help="Request word timestamps with each clip and export them on master-track time.")
+
 # Main Area
 st.title(f"{task_name}")
 st.caption(f"Section: {section} | Logic: {task_config['mix_logic'].upper()}")
@@ -498,33 +1065,99 @@ with col_input:
                         df.columns = new_cols
                     
                     st.session_state['df'] = df
+                    st.session_state.pop('render', None)
                     st.success("Analysis Complete!")
 
+    if st.button("⚡ Parse & Generate (pipelined)", help="Starts voicing lines while Gemini is still parsing. Review and re-render from the table afterwards."):
+        if not key_gemini or not key_eleven:
+            st.error("Gemini and ElevenLabs API Keys are both required")
+        else:
+            df, clips, pipe_timings = stream_parse_and_synthesize(raw_text, task_name, task_config, key_gemini, key_eleven,
+                                                                     with_words=capture_words)
+            if clips:
+                st.session_state['df'] = df
+                t0 = time.perf_counter()
+                render = mix_track(clips, task_config)
+                if render:
+                    pipe_timings['mix'] = time.perf_counter() - t0
+                    render.update({"clips": clips, "task_config": task_config,
+                                   "timings": {"synthesis": pipe_timings['synthesis'], "mix": pipe_timings['mix']},
+                                   "pipeline_timings": pipe_timings})
+                    st.session_state['render'] = render
+
 with col_preview:
     st.subheader("2. Production")
     
     if 'df' in st.session_state:
         edited_df = st.data_editor(st.session_state['df'], num_rows="dynamic", use_container_width=True)
+        preview_mode = st.checkbox("⚡ Preview mode (low-bitrate mono, no ZIP)", value=False,
+                                   help="Quick check of pacing and voices. Promote it afterwards without re-synthesizing.")
         
         if st.button("🎙️ Generate Audio Track"):
             if not key_eleven:
                 st.error("ElevenLabs Key missing")
             else:
-                final_file, zip_file = produce_audio(edited_df, task_config, key_eleven)
+                render = produce_audio(edited_df, task_config, key_eleven, preview=preview_mode,
+                                       with_words=capture_words)
+                if render:
+                    st.session_state['render'] = render
+
+        render = st.session_state.get('render')
+        if render and render['preview']:
+            st.info("Preview render — check pacing and voices, then promote to the full-quality master.")
+            st.audio(render['master'])
+            st.caption(f"Preview: synthesis {render['timings']['synthesis']:.2f}s · encode {render['timings']['mix']:.2f}s")
+
+            if st.button("✅ Promote to Final Render", type="primary"):
+                final = promote_render(render)
+                if final:
+                    st.session_state['render'] = final
+                    st.rerun()
+
+        elif render:
+            st.success("Production Complete!")
+            if 'preview_timings' in render:
+                pt = render['preview_timings']
+                col_b1, col_b2 = st.columns(2)
+                col_b1.metric("Preview render", f"{pt['synthesis'] + pt['mix']:.2f}s")
+                col_b2.metric("Promote to final (no TTS)", f"{render['timings']['mix']:.2f}s")
+            if 'pipeline_timings' in render:
+                pt = render['pipeline_timings']
+                st.caption(f"Pipelined: parse {pt['parse']:.2f}s · parse + voices {pt['synthesis']:.2f}s · mix {pt['mix']:.2f}s")
+            
+            st.write("### ⬇️ Downloads")
+            col_d1, col_d2, col_d3 = st.columns(3)
+            
+            with col_d1:
+                with open(render['master'], "rb") as f:
+                    st.download_button("🎵 Master Track (MP3)", f, "toefl_master.mp3", type="primary")
+                st.audio(render['master'])
                 
-                if final_file and zip_file:
-                    st.success("Production Complete!")
-                    
-                    st.write("### ⬇️ Downloads")
-                    col_d1, col_d2 = st.columns(2)
-                    
-                    with col_d1:
-                        with open(final_file, "rb") as f:
-                            st.download_button("🎵 Master Track (MP3)", f, "toefl_master.mp3", type="primary")
-                        st.audio(final_file)
-                        
-                    with col_d2:
-                        with open(zip_file, "rb") as fz:
-                            st.download_button("🗂️ Individual Clips (ZIP)", fz, "clips.zip")
+            with col_d2:
+                with open(render['zip'], "rb") as fz:
+                    st.download_button("🗂️ Individual Clips (ZIP)", fz, "clips.zip")
+
+            with col_d3:
+                with open(render['cues']['json'], "rb") as fj:
+                    st.download_button("🧭 Timeline (JSON)", fj, "toefl_master.json")
+                with open(render['cues']['vtt'], "rb") as fv:
+                    st.download_button("💬 Subtitles (WebVTT)", fv, "toefl_master.vtt")
+                with open(render['cues']['srt'], "rb") as fs:
+                    st.download_button("💬 Subtitles (SRT)", fs, "toefl_master.srt")
+                if 'words' in render['cues']:
+                    with open(render['cues']['words'], "rb") as fw:
+                        st.download_button("🔤 Word Timings (JSON)", fw, "toefl_master.words.json")
+
+        if render:
+            with st.expander("〰️ Waveform", expanded=True):
+                if render['peaks']:
+                    st.line_chart(peaks_for_display(render['peaks']), height=160)
+                clip_names = [clip['name'] for clip in render['clips']]
+                picked = st.selectbox("Clip", clip_names)
+                if picked:
+                    clip = render['clips'][clip_names.index(picked)]
+                    st.caption(f"{clip['role']}: {clip['text']}")
+                    if get_clip_peaks(clip['path']) is not None:
+                        st.line_chart(peaks_for_display(clip_peaks_path(clip['path'])), height=120)
     else:
         st.info("Paste your script and click Analyze to begin.")
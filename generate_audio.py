@@ -1,8 +1,12 @@
 import os
+import base64
+import hashlib
+from datetime import datetime, timezone
 import pandas as pd
 from elevenlabs.client import ElevenLabs
 from elevenlabs import save
 from dotenv import load_dotenv
+from alignment import words_from_alignment, write_words_sidecar
 
 # Load environment variables
 load_dotenv()
@@ -13,6 +17,9 @@ print(f"API Key status: {'Loaded' if API_KEY else 'Not Loaded'}")
 INPUT_FILE = "input_data.csv"
 OUTPUT_DIR = "output"
 DEFAULT_VOICE_ID = "JBFqnCBsd6RMkjVDRZzb"  # George
+CHUNK_SIZE = 500  # CSV rows held in memory at once
+JOURNAL_FILE = os.path.join(OUTPUT_DIR, "journal.tsv")  # append-only: row_key, sha1, bytes, mtime_ns, timestamp
+WORD_TIMESTAMPS = os.getenv("WORD_TIMESTAMPS", "0") == "1"  # also write <clip>.words.json per row
 
 if not API_KEY:
     print("Error: ELEVENLABS_API_KEY not found in .env file.")
@@ -31,47 +38,141 @@ client = ElevenLabs(api_key=API_KEY)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def generate_audio(text, voice_id, output_path):
+    # Write to a temp name first so a crash never leaves a truncated mp3 behind
+    tmp_path = output_path + ".part"
     try:
-        audio = client.text_to_speech.convert(
-            text=text,
-            voice_id=voice_id,
-            model_id="eleven_multilingual_v2"
-        )
-        save(audio, output_path)
+        if WORD_TIMESTAMPS:
+            # Timings come back with the audio -- no separate alignment pass
+            response = client.text_to_speech.convert_with_timestamps(
+                text=text,
+                voice_id=voice_id,
+                model_id="eleven_multilingual_v2"
+            )
+            with open(tmp_path, 'wb') as f:
+                f.write(base64.b64decode(response.audio_base_64))
+            words = words_from_alignment(response.alignment) if response.alignment else []
+        else:
+            words = None
+            audio = client.text_to_speech.convert(
+                text=text,
+                voice_id=voice_id,
+                model_id="eleven_multilingual_v2"
+            )
+            save(audio, tmp_path)
+        os.replace(tmp_path, output_path)
+        # Sidecar only once the audio is in place; if this fails the row isn't journaled and reruns
+        if words is not None:
+            write_words_sidecar(words_path(output_path), words)
+        elif os.path.exists(words_path(output_path)):
+            os.remove(words_path(output_path))  # timings of the audio just replaced
         print(f"Successfully generated: {output_path}")
+        return True
     except Exception as e:
         print(f"Error generating {output_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def words_path(output_path):
+    return os.path.splitext(output_path)[0] + ".words.json"
+
+def row_key(filename, text, voice_id):
+    # Editing a row's text or voice changes its key, so it gets regenerated
+    return hashlib.sha1(f"{filename}|{voice_id}|{text}".encode("utf-8")).hexdigest()
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def file_stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None
+
+def output_matches(entry, path):
+    """
+    True if `path` is still the output the journal recorded. Size + mtime is one stat; the sha1 is only
+    read when the size matches but the mtime moved (copied/touched files, or pre-mtime journal lines).
+    """
+    if entry is None:
+        return False
+    stat = file_stat(path)
+    if stat is None or stat[0] != entry[1]:
+        return False
+    return stat[1] == entry[2] or file_digest(path) == entry[0]
+
+def journal_row(journal, key, path):
+    digest, (size, mtime_ns) = file_digest(path), file_stat(path)
+    journal.write(f"{key}\t{digest}\t{size}\t{mtime_ns}\t{datetime.now(timezone.utc).isoformat()}\n")
+    journal.flush()
+    return digest, size, mtime_ns
+
+def load_journal():
+    """
+    Map row_key -> (output sha1, output size, output mtime_ns) for every row a previous run finished.
+    """
+    done = {}
+    if not os.path.exists(JOURNAL_FILE):
+        return done
+    with open(JOURNAL_FILE, encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) == 4:
+                # Older line without mtime: resume falls back to the sha1 for it
+                done[parts[0]] = (parts[1], int(parts[2]), None)
+            elif len(parts) == 5:
+                done[parts[0]] = (parts[1], int(parts[2]), int(parts[3]))
+            # anything else is a torn last line from a killed run
+    return done
 
 def main():
     if not os.path.exists(INPUT_FILE):
         print(f"Error: {INPUT_FILE} not found.")
         return
 
-    df = pd.read_csv(INPUT_FILE)
-    
-    # Fill missing voice_ids with default
-    if 'voice_id' not in df.columns:
-        df['voice_id'] = DEFAULT_VOICE_ID
-    else:
-        df['voice_id'] = df['voice_id'].fillna(DEFAULT_VOICE_ID)
-
-    print(f"Found {len(df)} items to process.")
-
-    for index, row in df.iterrows():
-        filename = row['filename']
-        text = row['text']
-        voice_id = row['voice_id']
-        
-        # Add extension if missing
-        if not str(filename).endswith('.mp3'):
-            filename = f"{filename}.mp3"
-            
-        output_path = os.path.join(OUTPUT_DIR, filename)
-        
-        print(f"Processing [{index+1}/{len(df)}]: {filename}")
-        generate_audio(text, voice_id, output_path)
-
-    print("All done!")
+    done = load_journal()
+    if done:
+        print(f"Resuming: {len(done)} rows already in {JOURNAL_FILE}")
+
+    generated = skipped = failed = 0
+
+    with open(JOURNAL_FILE, 'a', encoding="utf-8") as journal:
+        for chunk in pd.read_csv(INPUT_FILE, chunksize=CHUNK_SIZE):
+            # Fill missing voice_ids with default
+            if 'voice_id' not in chunk.columns:
+                chunk['voice_id'] = DEFAULT_VOICE_ID
+            else:
+                chunk['voice_id'] = chunk['voice_id'].fillna(DEFAULT_VOICE_ID)
+
+            # Add extension if missing
+            names = chunk['filename'].astype(str)
+            chunk['filename'] = names.where(names.str.endswith('.mp3'), names + '.mp3')
+            chunk['output_path'] = [os.path.join(OUTPUT_DIR, name) for name in chunk['filename']]
+            chunk['key'] = [row_key(*r) for r in zip(chunk['filename'], chunk['text'], chunk['voice_id'])]
+
+            # Skip, in bulk, every journaled row whose output still matches the journal
+            # (and, with WORD_TIMESTAMPS, that has its sidecar next to it)
+            finished = pd.Series([output_matches(done.get(key), path)
+                                  and (not WORD_TIMESTAMPS or os.path.exists(words_path(path)))
+                                  for key, path in zip(chunk['key'], chunk['output_path'])],
+                                 index=chunk.index)
+            skipped += int(finished.sum())
+
+            for row in chunk[~finished].itertuples():
+                print(f"Processing [row {row.Index + 1}]: {row.filename}")
+                if not generate_audio(row.text, row.voice_id, row.output_path):
+                    failed += 1
+                    continue
+
+                done[row.key] = journal_row(journal, row.key, row.output_path)
+                generated += 1
+
+    print(f"All done! Generated {generated}, skipped {skipped} already complete, {failed} failed.")
 
 if __name__ == "__main__":
     main()